@@ -40,7 +40,7 @@ from model import GPT4RecommendationBaseModel
 from model import ContentGPTForUserItemWithLMHeadBatch
 from model import CollaborativeGPTwithItemRecommendHead
 
-from util import Recall_at_k, NDCG_at_k
+from util import Recall_at_k, NDCG_at_k, topk_indices
     
 def save_local(remote_path, local_path, remote_mode, local_mode):
     '''
@@ -486,11 +486,12 @@ def main():
                 target_mat = target_mat.cpu().numpy()
                 item_scores = item_scores.cpu().numpy()
                 val_rec_loss += rec_loss.item()
-                cur_recall_1 += Recall_at_k(target_mat, item_scores, k=1, agg="sum")
-                cur_recall_5 += Recall_at_k(target_mat, item_scores, k=5, agg="sum")
-                cur_recall_10 += Recall_at_k(target_mat, item_scores, k=10, agg="sum")
-                cur_NDCG_5 += NDCG_at_k(target_mat, item_scores, k=5, agg="sum")
-                cur_NDCG_10 += NDCG_at_k(target_mat, item_scores, k=10, agg="sum")
+                topk_idxes = topk_indices(item_scores, k=10)
+                cur_recall_1 += Recall_at_k(target_mat, item_scores, k=1, agg="sum", topk_idxes=topk_idxes)
+                cur_recall_5 += Recall_at_k(target_mat, item_scores, k=5, agg="sum", topk_idxes=topk_idxes)
+                cur_recall_10 += Recall_at_k(target_mat, item_scores, k=10, agg="sum", topk_idxes=topk_idxes)
+                cur_NDCG_5 += NDCG_at_k(target_mat, item_scores, k=5, agg="sum", topk_idxes=topk_idxes)
+                cur_NDCG_10 += NDCG_at_k(target_mat, item_scores, k=10, agg="sum", topk_idxes=topk_idxes)
 
         # Calculate average Recall@K and NDCG@K for the validation set
         val_rec_loss /= len(val_data_loader)
@@ -3,13 +3,36 @@ MIT License
 Copyright (c) 2024 Yaochen Zhu
 '''
 
+import os
 import random
 import fsspec
 import pickle
+import numpy as np
 
 import torch
 from torch.utils.data import Dataset
 
+from util import write_local_key, is_local_fresh
+
+
+def attention_mask_from_lengths(lengths, seq_length):
+    """
+    Build the attention mask of right-padded prompts.
+
+    Args:
+        lengths (torch.Tensor): 
+            Length of each prompt, of shape [batch_size].
+        seq_length (int): 
+            Padded length of the prompts.
+
+    Returns:
+        torch.Tensor: 
+            Attention mask of shape [batch_size, seq_length],
+            on the same device as lengths.
+    """
+    positions = torch.arange(seq_length, device=lengths.device)
+    return (positions[None, :] < lengths[:, None]).long()
+
 
 class CollaborativeGPTGeneratorBatch(Dataset):
     """
@@ -264,15 +287,19 @@ class RecommendationGPTTestGeneratorBatch(Dataset):
     def __len__(self):
         return self.num_users
     
-    def __getitem__(self, idx):
+    def get_prompt(self, idx, rng=random):
         # Get past item interactions for the user
         input_interactions = self.train_mat.getrow(idx).nonzero()[1]
         if self.shuffle:
-            random.shuffle(input_interactions)
+            rng.shuffle(input_interactions)
         
         # Tokenize the input and create the target matrix
         input_prompt = f"user_{idx} has interacted with {' '.join(['item_' + str(item_id) for item_id in input_interactions])}"
         input_prompt += f", user_{idx} will interact with"
+        return input_prompt
+
+    def __getitem__(self, idx):
+        input_prompt = self.get_prompt(idx)
         
         # Obtain the training items
         train_interactions = self.train_mat.getrow(idx).nonzero()[1]
@@ -318,3 +345,145 @@ class RecommendationGPTTestGeneratorBatch(Dataset):
             attention_mask = attention_mask[:, :-excess_length]
 
         return prompt_ids, train_matrices, target_matrices, attention_mask
+
+
+class RecommendationGPTTestCachedGeneratorBatch(RecommendationGPTTestGeneratorBatch):
+    """
+    Dataset class for generating recommendation GPT test batches
+    from pre-tokenized prompts, with the interactions kept sparse.
+
+    All the prompts are tokenized once into a memory-mapped
+    [num_users, max_seq_length] array of token IDs (plus the
+    length of each prompt) under cache_root, so the collate
+    function only slices rows instead of running the tokenizer.
+    The item order of the prompts is shuffled with a fixed seed.
+    The cache is keyed by source_key together with the number
+    of users/items, max_length, shuffle and seed, and is rebuilt
+    when any of them changes.
+
+    Instead of dense [batch_size, num_items] matrices, the collate
+    function returns the user IDs of the batch, whose training 
+    interactions are looked up from a CSR matrix kept on the GPU,
+    and the (row, column) coordinates of the target interactions,
+    so that they can be masked and evaluated on the GPU in O(nnz).
+
+    Args:
+        cache_root (str):
+            Directory where the token cache is stored.
+        source_key (str):
+            Key of the training matrix and the tokenizer files
+            the prompts come from.
+        seed (int, optional):
+            Seed of the item order shuffle. Defaults to 0.
+        cache_batch_size (int, optional):
+            Number of prompts tokenized at a time when building
+            the cache. Defaults to 256.
+    """
+    def __init__(self, 
+                 tokenizer, 
+                 train_mat,
+                 test_mat,
+                 cache_root,
+                 source_key,
+                 max_length=1024, 
+                 predict_ratio=0.2,
+                 shuffle=True,
+                 seed=0,
+                 cache_batch_size=256):
+        super().__init__(tokenizer, train_mat, test_mat, 
+                         max_length=max_length,
+                         predict_ratio=predict_ratio,
+                         shuffle=shuffle)
+        self.seed = seed
+        self.input_ids_path = os.path.join(cache_root, "test_input_ids.npy")
+        self.lengths_path = os.path.join(cache_root, "test_lengths.npy")
+        
+        cache_key = "\n".join([source_key,
+                               f"num_users={self.num_users}",
+                               f"num_items={self.num_items}",
+                               f"max_length={max_length}",
+                               f"shuffle={shuffle}",
+                               f"seed={seed}"])
+        if not self.is_cache_valid(cache_key):
+            self.build_cache(cache_key, cache_batch_size)
+        self.input_ids = np.load(self.input_ids_path, mmap_mode="r")
+        self.lengths = np.load(self.lengths_path)
+
+    def is_cache_valid(self, cache_key):
+        return os.path.exists(self.lengths_path) and \
+               is_local_fresh(self.input_ids_path, cache_key)
+
+    def build_cache(self, cache_key, cache_batch_size):
+        if os.path.exists(self.input_ids_path + ".key"):
+            os.remove(self.input_ids_path + ".key")
+        rng = random.Random(self.seed)
+
+        # Write each batch as soon as it is encoded into a
+        # temporary cache as wide as the maximum length
+        tmp_path = self.input_ids_path.replace(".npy", ".tmp.npy")
+        tmp_cache = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.int32, 
+            shape=(self.num_users, self.max_length))
+        lengths = np.zeros(self.num_users, dtype=np.int64)
+        for start in range(0, self.num_users, cache_batch_size):
+            end = min(start + cache_batch_size, self.num_users)
+            input_ids, attention_mask = self.tokenizer.encode_batch(
+                [self.get_prompt(idx, rng) for idx in range(start, end)])
+            seq_length = min(self.max_length, input_ids.shape[1])
+            tmp_cache[start:end] = self.tokenizer.pad_token_id
+            tmp_cache[start:end, :seq_length] = input_ids[:, :seq_length]
+            lengths[start:end] = attention_mask[:, :seq_length].sum(axis=1)
+
+        # Copy the cache block by block, trimmed to the longest prompt
+        max_seq_length = int(lengths.max())
+        input_ids_cache = np.lib.format.open_memmap(
+            self.input_ids_path, mode="w+", dtype=np.int32, 
+            shape=(self.num_users, max_seq_length))
+        for start in range(0, self.num_users, cache_batch_size):
+            end = min(start + cache_batch_size, self.num_users)
+            input_ids_cache[start:end] = tmp_cache[start:end, :max_seq_length]
+        input_ids_cache.flush()
+        del tmp_cache
+        os.remove(tmp_path)
+        np.save(self.lengths_path, lengths)
+
+        # Write the key last so a partial cache is never valid
+        write_local_key(self.input_ids_path, cache_key)
+
+    def get_targets(self, user_ids):
+        # Row and column indices of the target items
+        target_matrices = (self.test_mat[user_ids] > 0).tocoo()
+        target_row = torch.from_numpy(target_matrices.row).long()
+        target_col = torch.from_numpy(target_matrices.col).long()
+        return target_row, target_col
+
+    def __getitem__(self, idx):
+        return idx
+
+    def collate_fn(self, batch):
+        """
+        Custom collate function to slice the cached prompts.
+
+        Args:
+            batch (List[int]): 
+                List of user IDs.
+
+        Returns:
+            Tuple[torch.Tensor, ...]: 
+                Tuple containing the padded prompt IDs, user IDs,
+                row and column indices of the target matrix,
+                and attention mask.
+        """
+        user_ids = list(batch)
+        lengths = self.lengths[user_ids]
+        seq_length = int(lengths.max())
+
+        # Get the prompt IDs and attention masks, padded to the longest prompt
+        prompt_ids = torch.from_numpy(self.input_ids[user_ids, :seq_length].astype(np.int64))
+        attention_mask = attention_mask_from_lengths(torch.from_numpy(lengths), seq_length)
+
+        # Slice the target interactions of the batch
+        target_row, target_col = self.get_targets(user_ids)
+        user_ids = torch.tensor(user_ids, dtype=torch.long)
+
+        return prompt_ids, user_ids, target_row, target_col, attention_mask
@@ -3,11 +3,14 @@ MIT License
 Copyright (c) 2024 Yaochen Zhu
 '''
 
+import types
+
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
 from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, MSELoss
 
+import transformers
 from transformers import GPT2Model, GPT2Config
 
 
@@ -268,10 +271,10 @@ class CollaborativeGPTwithItemRecommendHead(nn.Module):
         last_non_pad_token_indices = attention_mask.sum(dim=1) - 1
 
         # Gather the last non-padding token embeddings
-        last_token_hidden_states = torch.stack([
-            hidden_states[i, idx, :] for i, idx in \
-                enumerate(last_non_pad_token_indices)
-        ])
+        last_token_hidden_states = hidden_states[
+            torch.arange(hidden_states.shape[0], device=hidden_states.device),
+            last_non_pad_token_indices
+        ]
 
         # Calculate the item scores
         item_scores = self.item_head(last_token_hidden_states)
@@ -279,8 +282,11 @@ class CollaborativeGPTwithItemRecommendHead(nn.Module):
         # Convert scores to multinomial probabilities
         item_log_probs = F.log_softmax(item_scores, dim=-1)
         
-        # Calculating the multinomial loss
-        neg_ll = -torch.mean(torch.sum(item_log_probs * target_ids, dim=-1))
+        # Calculating the multinomial loss, which is skipped
+        # when only the item scores are needed (e.g., testing)
+        neg_ll = None
+        if target_ids is not None:
+            neg_ll = -torch.mean(torch.sum(item_log_probs * target_ids, dim=-1))
         
         if regularize:
             # User/Item token embeddings only appear in the prompt
@@ -300,3 +306,112 @@ class CollaborativeGPTwithItemRecommendHead(nn.Module):
         else: 
             outputs = (neg_ll, item_log_probs)
         return outputs
+
+
+def capture_safe_attn(self, query, key, value, attention_mask=None, head_mask=None):
+    '''
+        GPT2Attention._attn of transformers 4.24.0 with the scale
+        and the mask value created on the device. The original
+        builds them as host tensors copied to the GPU in every
+        layer, which is not allowed during a CUDA graph capture.
+    '''
+    attn_weights = torch.matmul(query, key.transpose(-1, -2))
+
+    if self.scale_attn_weights:
+        attn_weights = attn_weights / torch.full(
+            [], value.size(-1) ** 0.5, dtype=attn_weights.dtype, device=attn_weights.device
+        )
+
+    # Layer-wise attention scaling
+    if self.scale_attn_by_inverse_layer_idx:
+        attn_weights = attn_weights / float(self.layer_idx + 1)
+
+    if not self.is_cross_attention:
+        # if only "normal" attention layer implements causal mask
+        query_length, key_length = query.size(-2), key.size(-2)
+        causal_mask = self.bias[:, :, key_length - query_length : key_length, :key_length].to(torch.bool)
+        mask_value = torch.full([], torch.finfo(attn_weights.dtype).min, 
+                                dtype=attn_weights.dtype, device=attn_weights.device)
+        attn_weights = torch.where(causal_mask, attn_weights, mask_value)
+
+    if attention_mask is not None:
+        # Apply the attention mask
+        attn_weights = attn_weights + attention_mask
+
+    attn_weights = nn.functional.softmax(attn_weights, dim=-1)
+
+    # Downcast (if necessary) back to V's dtype (if in mixed-precision) -- No-Op otherwise
+    attn_weights = attn_weights.type(value.dtype)
+    attn_weights = self.attn_dropout(attn_weights)
+
+    # Mask heads if we want to
+    if head_mask is not None:
+        attn_weights = attn_weights * head_mask
+
+    attn_output = torch.matmul(attn_weights, value)
+    return attn_output, attn_weights
+
+
+class CUDAGraphRecommender(nn.Module):
+    '''
+        Replay the forward pass of rec_model from CUDA graphs.
+        Batches are padded to batch_size rows and to a multiple
+        of seq_bucket tokens; one graph is captured per padded
+        sequence length. Padded rows/tokens have a zero attention
+        mask and their scores are dropped before returning.
+    '''
+    def __init__(self, rec_model, batch_size, seq_bucket=64):
+        super(CUDAGraphRecommender, self).__init__()
+        self.rec_model = rec_model
+        self.batch_size = batch_size
+        self.seq_bucket = seq_bucket
+        self.graphs = {}
+        # Make the attention layers safe to capture, the patch
+        # is a copy of the attention of this exact version
+        assert transformers.__version__ == "4.24.0", \
+            f"capture_safe_attn is copied from transformers 4.24.0, got {transformers.__version__}"
+        assert not rec_model.base_model.config.reorder_and_upcast_attn, \
+            "the upcast attention path is not capture-safe"
+        for block in rec_model.base_model.gpt2model.h:
+            block.attn._attn = types.MethodType(capture_safe_attn, block.attn)
+        # The graphs never run concurrently and their outputs are
+        # consumed before the next replay, so they share one pool
+        self.pool = torch.cuda.graph_pool_handle()
+
+    def _run(self, input_ids, attention_mask):
+        # Autocast caching is not allowed inside a graph capture
+        with torch.autocast(device_type="cuda", dtype=torch.bfloat16, cache_enabled=False):
+            _, item_scores = self.rec_model(input_ids, None, attention_mask)
+        return item_scores.float()
+
+    def capture(self, seq_length, device):
+        static_input_ids = torch.zeros((self.batch_size, seq_length), dtype=torch.long, device=device)
+        static_attention_mask = torch.ones_like(static_input_ids)
+
+        # Warm up on a side stream before capturing
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self._run(static_input_ids, static_attention_mask)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self.pool):
+            static_scores = self._run(static_input_ids, static_attention_mask)
+        return graph, static_input_ids, static_attention_mask, static_scores
+
+    def forward(self, input_ids, target_ids=None, attention_mask=None):
+        num_rows, seq_length = input_ids.shape
+        padded_length = -(-seq_length // self.seq_bucket) * self.seq_bucket
+        if padded_length not in self.graphs:
+            self.graphs[padded_length] = self.capture(padded_length, input_ids.device)
+        graph, static_input_ids, static_attention_mask, static_scores = self.graphs[padded_length]
+
+        # Copy the batch into the static inputs and replay
+        static_input_ids.zero_()
+        static_attention_mask.zero_()
+        static_input_ids[:num_rows, :seq_length].copy_(input_ids)
+        static_attention_mask[:num_rows, :seq_length].copy_(attention_mask)
+        graph.replay()
+        return None, static_scores[:num_rows]
@@ -3,19 +3,64 @@ MIT License
 Copyright (c) 2024 Yaochen Zhu
 '''
 
+import os
 import numpy as np
+import torch
 
-def Recall_at_k(y_true, y_pred, k, agg="sum"):
+def read_local_key(local_path):
+    '''
+        Read the key stored in the sidecar next to local_path.
+    '''
+    with open(local_path + ".key") as f:
+        return f.read()
+
+
+def write_local_key(local_path, key):
+    '''
+        Store the key of local_path in its sidecar. It should
+        be written last, once local_path is complete.
+    '''
+    with open(local_path + ".key", "w") as f:
+        f.write(key)
+
+
+def is_local_fresh(local_path, remote_key):
+    '''
+        Check whether local_path already holds a copy of the
+        remote file identified by remote_key, which is stored
+        in a sidecar next to local_path after each copy.
+    '''
+    if not (os.path.exists(local_path) and os.path.exists(local_path + ".key")):
+        return False
+    return read_local_key(local_path) == remote_key
+
+
+def topk_indices(y_pred, k):
+    '''
+        Indices of the top k recommended items of each user,
+        sorted by the predicted scores. They can be shared by
+        Recall_at_k/NDCG_at_k for every cutoff no larger than k.
+    '''
+    topk_idxes_unsort = np.argpartition(-y_pred, k, axis=1)[:, :k]
+    topk_value_unsort = np.take_along_axis(y_pred, topk_idxes_unsort, axis=1)
+    topk_idxes_rel = np.argsort(-topk_value_unsort, axis=1)
+    return np.take_along_axis(topk_idxes_unsort, topk_idxes_rel, axis=1)
+
+
+def Recall_at_k(y_true, y_pred, k, agg="sum", topk_idxes=None):
     '''
         Average recall for top k recommended results.
-        The training records should be set to -inf in y_pred
+        The training records should be set to -inf in y_pred.
+        Sorted top (>= k) indices from topk_indices can be passed
+        as topk_idxes to skip the partition of y_pred.
     '''
-    batch_size = y_pred.shape[0]
-    topk_idxes = np.argpartition(-y_pred, k, axis=1)[:, :k]
-    y_pred_bin = np.zeros_like(y_pred, dtype=bool)
-    y_pred_bin[np.arange(batch_size)[:, None], topk_idxes] = True
+    if topk_idxes is None:
+        topk_idxes = np.argpartition(-y_pred, k, axis=1)[:, :k]
+    else:
+        topk_idxes = topk_idxes[:, :k]
+    # Only gather the relevance of the top k items
     y_true_bin = (y_true > 0)
-    hits = np.sum(np.logical_and(y_true_bin, y_pred_bin), axis=-1).astype(np.float32)
+    hits = np.sum(np.take_along_axis(y_true_bin, topk_idxes, axis=1), axis=-1).astype(np.float32)
     recalls = hits/np.minimum(k, np.sum(y_true_bin, axis=1))
     if agg == "sum":
         recall = np.sum(recalls)
@@ -26,24 +71,101 @@ def Recall_at_k(y_true, y_pred, k, agg="sum"):
     return recall
 
 
-def NDCG_at_k(y_true, y_pred, k, agg="sum"):
+def NDCG_at_k(y_true, y_pred, k, agg="sum", topk_idxes=None):
     '''
         Average NDCG for top k recommended results. 
-        The training records should be set to -inf in y_pred
+        The training records should be set to -inf in y_pred.
+        Sorted top (>= k) indices from topk_indices can be passed
+        as topk_idxes to skip the partition of y_pred.
     '''
 
-    batch_size = y_pred.shape[0]
-    topk_idxes_unsort = np.argpartition(-y_pred, k, axis=1)[:, :k]
-    topk_value_unsort = y_pred[np.arange(batch_size)[:, None],topk_idxes_unsort]
-    topk_idxes_rel = np.argsort(-topk_value_unsort, axis=1)
-    topk_idxes = topk_idxes_unsort[np.arange(batch_size)[:, None], topk_idxes_rel]
-    y_true_topk = y_true[np.arange(batch_size)[:, None], topk_idxes]
-    y_true_bin = (y_true > 0).astype(np.float32)
+    if topk_idxes is None:
+        topk_idxes = topk_indices(y_pred, k)
+    else:
+        topk_idxes = topk_idxes[:, :k]
+    y_true_topk = np.take_along_axis(y_true, topk_idxes, axis=1)
+    num_true = np.minimum(k, np.sum(y_true > 0, axis=-1))
     weights = 1./np.log2(np.arange(2, k + 2))
     DCG = np.sum(y_true_topk*weights, axis=-1)
-    normalizer = np.array([np.sum(weights[:int(n)]) for n in np.minimum(k, np.sum(y_true_bin, axis=-1))])
+    # Ideal DCG of n relevant items is the sum of the first n weights
+    ideal_DCG = np.concatenate(([0.], np.cumsum(weights)))
+    normalizer = ideal_DCG[num_true]
     if agg == "sum":
         NDCG = np.sum(DCG/normalizer)
     elif agg == "mean":
         NDCG = np.mean(DCG/normalizer)
+    else:
+        raise NotImplementedError(f"aggregation method {agg} not defined!")
+    return NDCG
+
+
+def csr_gather_rows(crow_indices, col_indices, rows, nnz):
+    '''
+        Gather the nnz non-zero entries in the given rows of
+        a CSR matrix. Return the position of each entry's row
+        in rows and the column index of each entry.
+    '''
+    starts = crow_indices[rows]
+    counts = crow_indices[rows + 1] - starts
+    row_idxes = torch.repeat_interleave(
+        torch.arange(rows.shape[0], device=rows.device),
+        counts,
+        output_size=nnz
+    )
+    # Offset of each entry within its own row
+    row_offsets = torch.cumsum(counts, dim=0) - counts
+    entry_offsets = torch.arange(nnz, device=rows.device) - row_offsets[row_idxes]
+    return row_idxes, col_indices[starts[row_idxes] + entry_offsets]
+
+
+def topk_hits(rows, cols, y_pred, k):
+    '''
+        Relevance of the top k recommended items of each user,
+        ordered by the predicted scores, where the relevant items
+        are given as the (rows, cols) coordinates of the non-zero
+        entries of y_true. Computed on the device of y_pred.
+        The training records should be set to -inf in y_pred
+    '''
+    batch_size, num_items = y_pred.shape
+    topk_idxes = torch.topk(y_pred, k, dim=-1).indices
+    user_offsets = torch.arange(batch_size, device=y_pred.device)[:, None]*num_items
+    # Both keys are unique (the top k items of a user are distinct and
+    # the coordinates come from a canonical sparse matrix), which keeps
+    # isin from calling torch.unique and synchronizing with the host
+    return torch.isin(user_offsets + topk_idxes, rows*num_items + cols, 
+                      assume_unique=True).float()
+
+
+def Recall_at_k_gpu(hits, num_true, k, agg="sum"):
+    '''
+        Average recall for top k recommended results, where hits
+        are the sorted top (>= k) relevances from topk_hits and
+        num_true is the number of relevant items of each user.
+    '''
+    recalls = torch.sum(hits[:, :k], dim=-1)/torch.clamp(num_true, max=k)
+    if agg == "sum":
+        recall = torch.sum(recalls)
+    elif agg == "mean":
+        recall = torch.mean(recalls)
+    else:
+        raise NotImplementedError(f"aggregation method {agg} not defined!")
+    return recall
+
+
+def NDCG_at_k_gpu(hits, num_true, k, agg="sum"):
+    '''
+        Average NDCG for top k recommended results, where hits
+        are the sorted top (>= k) relevances from topk_hits and
+        num_true is the number of relevant items of each user.
+    '''
+    weights = 1./torch.log2(torch.arange(2, k + 2, device=hits.device, dtype=torch.float32))
+    DCG = torch.sum(hits[:, :k]*weights, dim=-1)
+    ideal_DCG = torch.cat((weights.new_zeros(1), torch.cumsum(weights, dim=0)))
+    normalizer = ideal_DCG[torch.clamp(num_true, max=k).long()]
+    if agg == "sum":
+        NDCG = torch.sum(DCG/normalizer)
+    elif agg == "mean":
+        NDCG = torch.mean(DCG/normalizer)
+    else:
+        raise NotImplementedError(f"aggregation method {agg} not defined!")
     return NDCG
@@ -4,51 +4,64 @@ Copyright (c) 2024 Yaochen Zhu
 '''
 
 import time
-import re
 import os
 import sys
+import copy
 import pickle
+import shutil
+import zipfile
+import tempfile
 import fsspec
-import random
 import argparse
-from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
 import torch
 import torch.nn as nn
-import torch.optim as optim
-import torch.distributed as dist
-from torch.utils.data import Dataset
-from torch.nn import functional as F
-from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, MSELoss
 
-from scipy.sparse import load_npz
+from scipy.sparse import load_npz, csr_matrix, csc_matrix
 from torch.utils.data import DataLoader
+from accelerate import init_empty_weights
 from transformers import GPT2Model, GPT2Config
-from transformers import GPT2Tokenizer
 
 sys.path.append("libs")
 from tokenizer import TokenizerWithUserItemIDTokensBatch
 
-from data import UserItemContentGPTDatasetBatch
-from data import RecommendationGPTTrainGeneratorBatch
-from data import RecommendationGPTTestGeneratorBatch
+from data import RecommendationGPTTestCachedGeneratorBatch, attention_mask_from_lengths
 
 from model import GPT4RecommendationBaseModel
-from model import ContentGPTForUserItemWithLMHeadBatch
 from model import CollaborativeGPTwithItemRecommendHead
-from util import Recall_at_k, NDCG_at_k
+from model import CUDAGraphRecommender
+from util import csr_gather_rows, topk_hits, Recall_at_k_gpu, NDCG_at_k_gpu
+from util import read_local_key, write_local_key, is_local_fresh
     
+chunk_size = 4 * 1024 * 1024
+
 def save_local(remote_path, local_path, remote_mode, local_mode):
     '''
         Save the remote file in remote_path
-        to the local_path...
+        to the local_path, unless the local
+        copy is already up to date...
     '''
-    with fsspec.open(remote_path, remote_mode) as f:
-        content = f.read()
-    with fsspec.open(local_path, local_mode) as f:
-        f.write(content)
+    # The key covers the remote path (hence the dataset)
+    # and the backend's unique key of the file content
+    fs, path = fsspec.core.url_to_fs(remote_path)
+    remote_key = f"{remote_path}\n{fs.ukey(path)}"
+    if is_local_fresh(local_path, remote_key):
+        return
+
+    # Copy in chunks so that large files (e.g., the
+    # pretrained weights) are never held in memory
+    key_path = local_path + ".key"
+    if os.path.exists(key_path):
+        os.remove(key_path)
+    with fs.open(path, remote_mode, block_size=chunk_size) as src, \
+         fsspec.open(local_path, local_mode) as dst:
+        shutil.copyfileobj(src, dst, length=chunk_size)
+
+    # Write the key last so a partial copy is never fresh
+    write_local_key(local_path, remote_key)
 
 
 def save_remote(local_path, remote_path, local_mode, remote_mode):
@@ -61,8 +74,189 @@ def save_remote(local_path, remote_path, local_mode, remote_mode):
     with fsspec.open(remote_path, remote_mode) as f:
         f.write(content)
 
+def load_npz_mmap(path):
+    '''
+        Load the sparse matrix saved by scipy.sparse.save_npz
+        in path with memory-mapped data/indices/indptr arrays.
+        The arrays are extracted once next to path, since a
+        compressed .npz cannot be mapped in place, and are
+        reused while the key of path (written by save_local)
+        is unchanged. Formats other than CSR/CSC are loaded
+        eagerly.
+    '''
+    with np.load(path) as loader:
+        matrix_format = loader["format"].item()
+        shape = tuple(loader["shape"])
+    if not isinstance(matrix_format, str):
+        matrix_format = matrix_format.decode("ascii")
+    if matrix_format not in ("csr", "csc"):
+        return load_npz(path)
+
+    extract_root = os.path.splitext(path)[0]
+    members = ["data.npy", "indices.npy", "indptr.npy"]
+    member_paths = [os.path.join(extract_root, member) for member in members]
+    # The directory is moved into place whole, and its sidecar
+    # records the key of the archive it was extracted from
+    archive_key = read_local_key(path)
+    if not is_local_fresh(extract_root, archive_key):
+        # Extract into a temporary directory and move it into
+        # place, so an interrupted extraction is never reused
+        tmp_root = tempfile.mkdtemp(dir=os.path.dirname(extract_root) or ".")
+        with zipfile.ZipFile(path) as zf:
+            zf.extractall(tmp_root, members=members)
+        if os.path.exists(extract_root):
+            shutil.rmtree(extract_root)
+        os.replace(tmp_root, extract_root)
+        write_local_key(extract_root, archive_key)
+
+    data, indices, indptr = [np.load(member_path, mmap_mode="r") for member_path in member_paths]
+    matrix_cls = csr_matrix if matrix_format == "csr" else csc_matrix
+    return matrix_cls((data, indices, indptr), shape=shape)
+
+
+def load_weights(path, map_location):
+    '''
+        Load the tensors saved in path by memory-mapping
+        the file, so only the touched storages are read.
+        Files in the legacy (non-zip) format cannot be
+        mapped and are loaded eagerly instead.
+    '''
+    return torch.load(path, 
+                      map_location=map_location, 
+                      mmap=zipfile.is_zipfile(path), 
+                      weights_only=True)
+
+
+class EncoderForExport(nn.Module):
+    '''
+        Wrap the base model so that the ONNX graph only
+        contains the (non-standard) embedding + GPT2 encoder
+        and returns the last hidden states.
+    '''
+    def __init__(self, base_model):
+        super(EncoderForExport, self).__init__()
+        self.base_model = base_model
+
+    def forward(self, input_ids, attention_mask):
+        return self.base_model(input_ids, 
+                               attention_mask=attention_mask, 
+                               return_dict=False)[0]
+
+
+class ONNXRuntimeEncoder(nn.Module):
+    '''
+        Drop-in replacement of the base model that runs the
+        exported encoder with onnxruntime. The inputs and the
+        hidden states are bound in place on the torch device
+        when the session has the CUDA provider, and on the host
+        otherwise. The item head stays in PyTorch.
+    '''
+    def __init__(self, session, hidden_size):
+        super(ONNXRuntimeEncoder, self).__init__()
+        self.session = session
+        self.hidden_size = hidden_size
+        # Without the CUDA provider (e.g., the CPU build of
+        # onnxruntime) there is no CUDA allocator to bind to
+        self.on_cuda = "CUDAExecutionProvider" in session.get_providers()
+
+    def forward(self, input_ids=None, attention_mask=None, **kwargs):
+        device = input_ids.device
+        bind_device = device if self.on_cuda else torch.device("cpu")
+        device_id = bind_device.index or 0
+        input_ids = input_ids.to(bind_device).long().contiguous()
+        attention_mask = attention_mask.to(bind_device).long().contiguous()
+        hidden_states = torch.empty((*input_ids.shape, self.hidden_size), 
+                                    dtype=torch.float32, device=bind_device)
+
+        binding = self.session.io_binding()
+        binding.bind_input("input_ids", bind_device.type, device_id, np.int64,
+                           tuple(input_ids.shape), input_ids.data_ptr())
+        binding.bind_input("attention_mask", bind_device.type, device_id, np.int64,
+                           tuple(attention_mask.shape), attention_mask.data_ptr())
+        binding.bind_output("last_hidden_state", bind_device.type, device_id, np.float32,
+                            tuple(hidden_states.shape), hidden_states.data_ptr())
+
+        # onnxruntime runs on its own stream, the inputs
+        # copied by torch must be ready before it reads them
+        if bind_device.type == "cuda":
+            torch.cuda.current_stream().synchronize()
+        self.session.run_with_iobinding(binding)
+        return (hidden_states.to(device),)
+
+
+def export_int8_encoder(base_model, input_ids, attention_mask, int8_path):
+    '''
+        Export the encoder of the base model to ONNX and
+        dynamically quantize its weights to INT8 in int8_path.
+        The quantized model is moved into place last, so an
+        interrupted export is never reused.
+    '''
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    onnx_path = int8_path.replace("_int8.onnx", ".onnx")
+    dynamic_axes = {
+        "input_ids": {0: "batch_size", 1: "seq_length"},
+        "attention_mask": {0: "batch_size", 1: "seq_length"},
+        "last_hidden_state": {0: "batch_size", 1: "seq_length"},
+    }
+    torch.onnx.export(EncoderForExport(base_model),
+                      (input_ids, attention_mask),
+                      onnx_path,
+                      input_names=["input_ids", "attention_mask"],
+                      output_names=["last_hidden_state"],
+                      dynamic_axes=dynamic_axes,
+                      opset_version=17)
+    tmp_path = int8_path.replace(".onnx", ".tmp.onnx")
+    quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QInt8)
+    os.replace(tmp_path, int8_path)
+
+
+def record_event():
+    '''
+        Record a timing event on the current CUDA stream.
+    '''
+    event = torch.cuda.Event(enable_timing=True)
+    event.record()
+    return event
+
+
+def score_items(rec_model, input_ids, attention_mask):
+    '''
+        Get the item scores of a batch of users.
+    '''
+    # The GPT2 forward runs in bf16, the embeddings stay in fp32
+    with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
+        _, item_scores = rec_model(input_ids, 
+                                   None, 
+                                   attention_mask)
+    # Keep the masking and the metrics in fp32
+    return item_scores.float()
+
+
+def evaluate_scores(item_scores, train_row, train_col, target_row, target_col):
+    '''
+        Mask the training items in item_scores (in place) and
+        return the summed Recall@1/5/10 and NDCG@5/10 of the
+        users as scalar tensors on the GPU.
+    '''
+    # Set score of interacted items to the lowest
+    item_scores[train_row, train_col] = -float("inf")
+
+    # Calculate Recall@K and NDCG@K for each user on the GPU
+    hits = topk_hits(target_row, target_col, item_scores, k=10)
+    # index_add_ instead of bincount, which syncs to find the maximum
+    num_true = torch.zeros(item_scores.shape[0], dtype=torch.long, device=item_scores.device)
+    num_true.index_add_(0, target_row, torch.ones_like(target_row))
+    return (Recall_at_k_gpu(hits, num_true, k=1, agg="sum"),
+            Recall_at_k_gpu(hits, num_true, k=5, agg="sum"),
+            Recall_at_k_gpu(hits, num_true, k=10, agg="sum"),
+            NDCG_at_k_gpu(hits, num_true, k=5, agg="sum"),
+            NDCG_at_k_gpu(hits, num_true, k=10, agg="sum"))
+
+
 server_root = "/datain/v-yinju/rqvae-zzx/models/cllm4rec"
 local_root = "tmp"
+resident_memory_fraction = 0.5
 if not os.path.exists(local_root):
     os.makedirs(local_root, exist_ok=True)
 
@@ -98,11 +292,16 @@ _config = {
     "vocab_size": 50257
 }
 
+# Parse the config once, main() extends a copy of it
+_CONFIG_OBJ = GPT2Config(**_config)
+
 def main():
     # Parse the command line arguments
     parser = argparse.ArgumentParser()
     parser.add_argument("--dataset", type=str, help="specify the dataset for experiment")
     parser.add_argument("--lambda_V", type=str, help="specify the dataset for experiment")
+    parser.add_argument("--backend", type=str, default="eager", choices=["eager", "compile", "cuda_graph", "onnx_int8"],
+                        help="specify the inference backend of the recommendation model")
     args = parser.parse_args()
     
     dataset = args.dataset
@@ -110,6 +309,7 @@ def main():
     print("-----Current Setting-----")
     print(f"dataset: {dataset}")
     print(f"lambda_V: {args.lambda_V}")
+    print(f"backend: {args.backend}")
     
     # Define the device
     device = "cuda"
@@ -137,12 +337,11 @@ def main():
 
 
     '''
-        Obtain the tokenizer with user/item tokens
+        Fetch the remote files in parallel
     '''
-    print("-----Begin Obtaining the Tokenizer-----")
+    print("-----Begin Fetching the Remote Files-----")
     # tokenizer_root = os.path.join(server_root, "model", "pretrained", "tokenizer")
     tokenizer_root = '/datain/v-yinju/gpt2'
-    print(f"Loading pretrained tokenizer from {tokenizer_root}...")
     # remote_vocab_file = os.path.join(tokenizer_root, "vocab_file.json")
     remote_vocab_file = os.path.join(tokenizer_root, "vocab.json")
     remote_merges_file = os.path.join(tokenizer_root, "merges.txt")
@@ -150,8 +349,49 @@ def main():
     vocab_file = os.path.join(local_root, "vocab.json")
     merges_file = os.path.join(local_root, "merges.txt")
 
-    save_local(remote_vocab_file, vocab_file, "r", "w")
-    save_local(remote_merges_file, merges_file, "r", "w")
+    remote_train_mat_path = os.path.join(data_root, "train_matrix.npz")
+    local_train_mat_path = os.path.join(local_root, "train_matrix.npz")
+    remote_test_mat_path = os.path.join(data_root, "test_matrix.npz")
+    local_test_mat_path = os.path.join(local_root, "test_matrix.npz")
+
+    # pretrained_root = os.path.join(server_root, "model", "pretrained")
+    pretrained_root = '/datain/v-yinju/gpt2'
+    # remote_pretrained_weights_path = os.path.join(pretrained_root, "gpt2", "pytorch_model.bin")
+    # local_pretrained_weights_path = os.path.join(local_root, "gpt2", "pytorch_model.bin")
+    remote_pretrained_weights_path = os.path.join(pretrained_root, "pytorch_model.bin")
+    local_pretrained_weights_path = os.path.join(local_root, "pytorch_model.bin")
+
+    # rec_root = os.path.join(server_root, "model", dataset, "rec")
+    rec_root = os.path.join(server_root, dataset, "rec")
+    remote_pretrained_user_emb_path = os.path.join(rec_root, f"user_embeddings_{args.lambda_V}.pt") 
+    remote_pretrained_item_emb_path = os.path.join(rec_root, f"item_embeddings_{args.lambda_V}.pt") 
+    local_pretrained_user_emb_path = os.path.join(local_root, f"user_embeddings_{args.lambda_V}.pt")
+    local_pretrained_item_emb_path = os.path.join(local_root, f"item_embeddings_{args.lambda_V}.pt")
+
+    tasks = [
+        (remote_vocab_file, vocab_file, "r", "w"),
+        (remote_merges_file, merges_file, "r", "w"),
+        (remote_train_mat_path, local_train_mat_path, "rb", "wb"),
+        (remote_test_mat_path, local_test_mat_path, "rb", "wb"),
+        (remote_pretrained_weights_path, local_pretrained_weights_path, "rb", "wb"),
+        (remote_pretrained_user_emb_path, local_pretrained_user_emb_path, "rb", "wb"),
+        (remote_pretrained_item_emb_path, local_pretrained_item_emb_path, "rb", "wb"),
+    ]
+
+    # The downloads are independent, each file is only
+    # waited for right before it is first used below
+    download_pool = ThreadPoolExecutor(max_workers=len(tasks))
+    downloads = {task[1]: download_pool.submit(save_local, *task) for task in tasks}
+    print("-----End Fetching the Remote Files-----\n")
+
+
+    '''
+        Obtain the tokenizer with user/item tokens
+    '''
+    print("-----Begin Obtaining the Tokenizer-----")
+    print(f"Loading pretrained tokenizer from {tokenizer_root}...")
+    downloads[vocab_file].result()
+    downloads[merges_file].result()
         
     tokenizer = TokenizerWithUserItemIDTokensBatch(vocab_file, 
                                                    merges_file,
@@ -165,19 +405,22 @@ def main():
         Obtain the testing data generator
     '''
     print("-----Begin Obtaining the Collaborative Data Generator-----")
-    remote_train_mat_path = os.path.join(data_root, "train_matrix.npz")
-    local_train_mat_path = os.path.join(local_root, "train_matrix.npz")
     print(f"Loading data from {remote_train_mat_path}...")
-    save_local(remote_train_mat_path, local_train_mat_path, "rb", "wb")
-    
-    remote_test_mat_path = os.path.join(data_root, "test_matrix.npz")
-    local_test_mat_path = os.path.join(local_root, "test_matrix.npz")
-    save_local(remote_test_mat_path, local_test_mat_path, "rb", "wb")
+    downloads[local_train_mat_path].result()
+    downloads[local_test_mat_path].result()
     
     # Get the testing data generator
-    train_mat = load_npz(local_train_mat_path)
-    test_mat = load_npz(local_test_mat_path)
-    test_data_gen = RecommendationGPTTestGeneratorBatch(tokenizer, train_mat, test_mat)
+    train_mat = load_npz_mmap(local_train_mat_path)
+    test_mat = load_npz_mmap(local_test_mat_path)
+    # The prompts are tokenized once and cached under local_root
+    # The prompts are rebuilt whenever the training matrix or
+    # the tokenizer files differ from the ones they come from
+    source_key = "\n".join(read_local_key(path) for path in 
+                           [local_train_mat_path, vocab_file, merges_file])
+    test_data_gen = RecommendationGPTTestCachedGeneratorBatch(
+        tokenizer, train_mat, test_mat, 
+        cache_root=local_root,
+        source_key=source_key)
 
     print("Success!")
     print("-----End Obtaining the Collaborative Data Generator-----\n")
@@ -187,7 +430,7 @@ def main():
         Extend the config of the original GPT model
     '''
     print("-----Begin Setting Up the Config-----")
-    config = GPT2Config(**_config)
+    config = copy.copy(_CONFIG_OBJ)
     config.num_users = num_users
     config.num_items = num_items
     print("Success!")
@@ -198,16 +441,16 @@ def main():
         Instantiate the pretrained GPT2 model
     '''
     print("-----Begin Instantiating the Pretrained GPT Model-----")
-    gpt2model = GPT2Model(config)
-    # pretrained_root = os.path.join(server_root, "model", "pretrained")
-    pretrained_root = '/datain/v-yinju/gpt2'
+    # Skip the random initialization of the parameters, the
+    # loaded GPU tensors are adopted directly by the model
+    with init_empty_weights(include_buffers=False):
+        gpt2model = GPT2Model(config)
     print(f"Loading pretrained weights from {pretrained_root}...")
-    # remote_pretrained_weights_path = os.path.join(pretrained_root, "gpt2", "pytorch_model.bin")
-    # local_pretrained_weights_path = os.path.join(local_root, "gpt2", "pytorch_model.bin")
-    remote_pretrained_weights_path = os.path.join(pretrained_root, "pytorch_model.bin")
-    local_pretrained_weights_path = os.path.join(local_root, "pytorch_model.bin")
-    save_local(remote_pretrained_weights_path, local_pretrained_weights_path, "rb", "wb")
-    gpt2model.load_state_dict(torch.load(local_pretrained_weights_path), strict=False)
+    downloads[local_pretrained_weights_path].result()
+    gpt2model.load_state_dict(load_weights(local_pretrained_weights_path, device), 
+                              strict=False, assign=True)
+    missing_params = [name for name, param in gpt2model.named_parameters() if param.is_meta]
+    assert not missing_params, f"pretrained weights miss parameters {missing_params}"
     print("Success!")
     print("-----End Instantiating the Pretrained GPT Model-----\n")
 
@@ -218,21 +461,15 @@ def main():
     print("-----Begin Instantiating the Content GPT Model-----")
     base_model = GPT4RecommendationBaseModel(config, gpt2model)
 
-    # pretrained_root = os.path.join(server_root, "model", dataset, "rec")
-    pretrained_root = os.path.join(server_root, dataset, "rec")
-    remote_pretrained_user_emb_path = os.path.join(pretrained_root, f"user_embeddings_{args.lambda_V}.pt") 
-    remote_pretrained_item_emb_path = os.path.join(pretrained_root, f"item_embeddings_{args.lambda_V}.pt") 
-    local_pretrained_user_emb_path = os.path.join(local_root, f"user_embeddings_{args.lambda_V}.pt")
-    local_pretrained_item_emb_path = os.path.join(local_root, f"item_embeddings_{args.lambda_V}.pt")
-    
-    save_local(remote_pretrained_user_emb_path, local_pretrained_user_emb_path, "rb", "wb")
-    save_local(remote_pretrained_item_emb_path, local_pretrained_item_emb_path, "rb", "wb")    
+    downloads[local_pretrained_user_emb_path].result()
+    downloads[local_pretrained_item_emb_path].result()
+    download_pool.shutdown()
 
     base_model.user_embeddings.load_state_dict(
-        torch.load(local_pretrained_user_emb_path, map_location=device))
+        load_weights(local_pretrained_user_emb_path, device))
     print("Load pretrained user embeddings: Success!")
     base_model.item_embeddings.load_state_dict(
-        torch.load(local_pretrained_item_emb_path, map_location=device))
+        load_weights(local_pretrained_item_emb_path, device))
     print("Load pretrained item embeddings: Success!")
 
     rec_model = CollaborativeGPTwithItemRecommendHead(config, base_model)
@@ -240,63 +477,172 @@ def main():
     print("-----End Instantiating the Content GPT Model-----\n")
 
     
-    '''
-        Create a data sampler for distributed training
-    '''
-    print("-----Begin Creating the DataLoader-----")
-
-    # Create the testing data loader
+    # Number of users scored per forward pass
     # Note that we only do the testing in the main process!
     batch_size = 256
-    test_data_loader = DataLoader(test_data_gen, 
-                                  batch_size=batch_size, 
-                                  collate_fn=test_data_gen.collate_fn)
-    print("-----End Creating the DataLoader-----\n")
 
     # Set the model to the training mode
     rec_model.to(device)
     
     # Set the model to evaluation mode
     rec_model.eval()  
-    cur_recall_1 = 0
-    cur_recall_5 = 0
-    cur_recall_10 = 0
-    cur_NDCG_5 = 0
-    cur_NDCG_10 = 0
+
+    if args.backend == "compile":
+        # Fuse the GPT2 kernels and replay them with CUDA graphs,
+        # the sequence length varies across batches
+        rec_model = torch.compile(rec_model, mode="reduce-overhead", 
+                                  fullgraph=False, dynamic=True)
+    elif args.backend == "cuda_graph":
+        # Capture the forward once per padded sequence length
+        # and replay it with a single launch for every batch
+        rec_model = CUDAGraphRecommender(rec_model, batch_size)
+    elif args.backend == "onnx_int8":
+        # Run the encoder with INT8 weights in onnxruntime,
+        # the recommendation head is kept in PyTorch. Note that
+        # the dynamically quantized ops run on the CPU provider
+        import onnxruntime
+        print("-----Begin Quantizing the Encoder-----")
+        # Reuse the quantized model only if it was exported from
+        # the same weights, i.e., the keys of their remote copies
+        int8_path = os.path.join(local_root, "rec_int8.onnx")
+        weight_paths = [local_pretrained_weights_path,
+                        local_pretrained_user_emb_path,
+                        local_pretrained_item_emb_path]
+        int8_key = "\n".join(read_local_key(path) for path in weight_paths)
+        if is_local_fresh(int8_path, int8_key):
+            print(f"Reusing {int8_path}")
+        else:
+            if os.path.exists(int8_path + ".key"):
+                os.remove(int8_path + ".key")
+            # Export with one batch of prompts collated in place
+            sample_users = list(range(min(batch_size, len(test_data_gen))))
+            input_ids, *_, attention_mask = test_data_gen.collate_fn(sample_users)
+            with torch.no_grad():
+                export_int8_encoder(rec_model.base_model, 
+                                    input_ids.to(device), 
+                                    attention_mask.to(device), 
+                                    int8_path)
+            write_local_key(int8_path, int8_key)
+        session = onnxruntime.InferenceSession(
+            int8_path, providers=["CUDAExecutionProvider", "CPUExecutionProvider"])
+        rec_model.base_model = ONNXRuntimeEncoder(session, config.n_embd)
+        print("-----End Quantizing the Encoder-----\n")
+
+    # The training interactions are static, keep them on the GPU
+    # as one CSR matrix and look up the rows of each batch there
+    train_csr = train_mat.tocsr()
+    train_crow_host = torch.from_numpy(train_csr.indptr.astype(np.int64))
+    train_crow_all = train_crow_host.to(device)
+    # Upload the mapped column indices block by block and widen
+    # them on the GPU, so they are never copied into host memory
+    train_col_all = torch.empty(train_csr.nnz, dtype=torch.long, device=device)
+    for lo in range(0, train_csr.nnz, chunk_size):
+        hi = min(lo + chunk_size, train_csr.nnz)
+        train_col_all[lo:hi] = torch.from_numpy(np.array(train_csr.indices[lo:hi]))
+
+    # Evaluate the whole test set from GPU-resident inputs when
+    # it fits in a fraction of the free GPU memory, the rest is
+    # left for the activations. Besides the token IDs and the item
+    # scores, the single metric pass over all the users allocates
+    # the gathered training entries (with their offsets), the
+    # target coordinates, and the keys and sort buffers of isin
+    num_test_users = len(test_data_gen)
+    max_seq_length = test_data_gen.input_ids.shape[1]
+    num_hit_keys = num_test_users * 10 + test_mat.nnz
+    resident_bytes = (num_test_users * (max_seq_length * 8 + num_items * 4)
+                      + train_csr.nnz * 32
+                      + test_mat.nnz * 24
+                      + num_hit_keys * 32)
+    free_memory, _ = torch.cuda.mem_get_info(device)
+    resident_budget = int(free_memory * resident_memory_fraction)
+    resident = resident_bytes < resident_budget
+    print(f"resident evaluation: {resident}")
+
+
+    '''
+        Create a data sampler for distributed training
+    '''
+    if not resident:
+        print("-----Begin Creating the DataLoader-----")
+
+        # The loader is only needed when the inputs are not
+        # resident on the GPU. Pinned batches are prefetched by the workers and
+        # copied to the GPU asynchronously in the loop below
+        test_data_loader = DataLoader(test_data_gen, 
+                                      batch_size=batch_size, 
+                                      collate_fn=test_data_gen.collate_fn,
+                                      pin_memory=True,
+                                      num_workers=4,
+                                      persistent_workers=True,
+                                      prefetch_factor=4)
+        print("-----End Creating the DataLoader-----\n")
+
+    # Recall@1, Recall@5, Recall@10, NDCG@5, NDCG@10, accumulated
+    # on the GPU so the batches are not synchronized with the host
+    cur_metrics = torch.zeros(5, device=device)
+
+    # CUDA events timing the forward passes and the metrics, 
+    # they are only read after the final synchronization
+    forward_events, metric_events = [], []
 
     with torch.no_grad():
         start = time.time()
-        for input_ids, train_mat, target_mat, attention_mask in test_data_loader:
-            # Move tensors to the correct device
-            input_ids = input_ids.to(device)
-            train_mat = train_mat.to(device)
-            target_mat = target_mat.to(device)
-            attention_mask = attention_mask.to(device)
-
-            # Get item scores and rank them
-            rec_loss, item_scores = rec_model(input_ids, 
-                                                target_mat, 
-                                                attention_mask)
-            
-            # Set score of interacted items to the lowest
-            item_scores[train_mat > 0] = -float("inf")  
-
-            # Calculate Recall@K and NDCG@K for each user
-            target_mat = target_mat.cpu().numpy()
-            item_scores = item_scores.cpu().numpy()
-            cur_recall_1 += Recall_at_k(target_mat, item_scores, k=1, agg="sum")
-            cur_recall_5 += Recall_at_k(target_mat, item_scores, k=5, agg="sum")
-            cur_recall_10 += Recall_at_k(target_mat, item_scores, k=10, agg="sum")
-            cur_NDCG_5 += NDCG_at_k(target_mat, item_scores, k=5, agg="sum")
-            cur_NDCG_10 += NDCG_at_k(target_mat, item_scores, k=10, agg="sum")
-    end = time.time()
-    print('Inference Time:', (start - end) / len(test_data_gen))
+        if resident:
+            input_ids_all = torch.from_numpy(test_data_gen.input_ids.astype(np.int64)).to(device)
+            lengths_all = torch.from_numpy(test_data_gen.lengths).to(device)
+            item_scores = torch.empty((num_test_users, num_items), device=device)
+            for lo in range(0, num_test_users, batch_size):
+                hi = min(lo + batch_size, num_test_users)
+                # Trim the chunk to its longest prompt
+                seq_length = int(test_data_gen.lengths[lo:hi].max())
+                input_ids = input_ids_all[lo:hi, :seq_length]
+                attention_mask = attention_mask_from_lengths(lengths_all[lo:hi], seq_length)
+                forward_start = record_event()
+                item_scores[lo:hi] = score_items(rec_model, input_ids, attention_mask)
+                forward_events.append((forward_start, record_event()))
+
+            user_ids = torch.arange(num_test_users, device=device)
+            train_row, train_col = csr_gather_rows(train_crow_all, train_col_all, 
+                                                   user_ids, int(train_crow_host[-1]))
+            target_row, target_col = test_data_gen.get_targets(np.arange(num_test_users))
+            target_row = target_row.to(device)
+            target_col = target_col.to(device)
+            metric_start = record_event()
+            cur_metrics += torch.stack(evaluate_scores(item_scores, train_row, train_col, 
+                                                       target_row, target_col))
+            metric_events.append((metric_start, record_event()))
+        else:
+            for input_ids, user_ids, target_row, target_col, attention_mask in test_data_loader:
+                # The number of training items is known on the host
+                train_nnz = int(torch.sum(train_crow_host[user_ids + 1] - train_crow_host[user_ids]))
+
+                # Move tensors to the correct device
+                input_ids = input_ids.to(device, non_blocking=True)
+                user_ids = user_ids.to(device, non_blocking=True)
+                target_row = target_row.to(device, non_blocking=True)
+                target_col = target_col.to(device, non_blocking=True)
+                attention_mask = attention_mask.to(device, non_blocking=True)
+
+                # Get item scores and rank them
+                forward_start = record_event()
+                item_scores = score_items(rec_model, input_ids, attention_mask)
+                forward_end = record_event()
+                train_row, train_col = csr_gather_rows(train_crow_all, train_col_all, 
+                                                       user_ids, train_nnz)
+                cur_metrics += torch.stack(evaluate_scores(item_scores, train_row, train_col, 
+                                                           target_row, target_col))
+                forward_events.append((forward_start, forward_end))
+                metric_events.append((forward_end, record_event()))
+        torch.cuda.synchronize()
+        end = time.time()
+    forward_time = sum(begin.elapsed_time(finish) for begin, finish in forward_events)
+    metric_time = sum(begin.elapsed_time(finish) for begin, finish in metric_events)
+    print('Inference Time:', (end - start) / len(test_data_gen))
+    print(f"Forward Time: {forward_time:.1f} ms")
+    print(f"Metric Time: {metric_time:.1f} ms")
     # Calculate average Recall@K and NDCG@K for the validation set
-    cur_recall_1 /= len(test_data_gen)
-    cur_recall_5 /= len(test_data_gen)
-    cur_recall_10 /= len(test_data_gen)
-    cur_NDCG_5 /= len(test_data_gen)
-    cur_NDCG_10 /= len(test_data_gen)
+    cur_recall_1, cur_recall_5, cur_recall_10, cur_NDCG_5, cur_NDCG_10 = \
+        [metric / len(test_data_gen) for metric in cur_metrics.tolist()]
     
     print(f"Final Testing Results:")
     print(f"Recall@1: {cur_recall_1:.4f}")